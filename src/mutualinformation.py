@@ -1,7 +1,20 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from skimage import color, io
-import math
+from skimage.util import img_as_ubyte
 import matplotlib.pyplot as plt
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError: #numba is optional, joint_counts falls back to np.bincount
+    njit = None
+try:
+    from fast_histogram import histogram2d
+except ImportError: #fast-histogram is optional as well
+    histogram2d = None
+
+#Below this many paired pixels the numba kernel is not worth its first-run compile
+NUMBA_MIN_PIXELS = 4000000
 
 def load(fname):
     '''
@@ -9,10 +22,12 @@ def load(fname):
     Args:
         fname: string of path to image
     Returns:
-        image: numpy array of corrected values
+        image: numpy uint8 array of grey values
     '''
     image = io.imread(fname)
-    image = image.astype(np.float64)
+    if image.dtype != np.uint8:
+        #rescale other bit depths (e.g. 16-bit PNG, float) instead of wrapping them
+        image = img_as_ubyte(image)
     return image
 
 def save(image, fname):
@@ -37,10 +52,7 @@ def extract_red(image):
     Returns:
         red_image: numpy array of shape (imageheight, imagewidth)
     '''
-    imagecopy = np.copy(image)
-    imagecopy[:,:,1] = 0
-    imagecopy[:,:,2] = 0
-    red_image = imagecopy[:,:,0]
+    red_image = np.ascontiguousarray(image[:,:,0])
     return red_image
 
 def extract_green(image):
@@ -52,10 +64,7 @@ def extract_green(image):
     Returns:
         green_image: numpy array of shape (imageheight, imagewidth)
     '''
-    imagecopy = np.copy(image)
-    imagecopy[:,:,0] = 0
-    imagecopy[:,:,2] = 0
-    green_image = imagecopy[:,:,1]
+    green_image = np.ascontiguousarray(image[:,:,1])
     return green_image
 
 def overlap(ref, temp, shift):
@@ -66,14 +75,10 @@ def overlap(ref, temp, shift):
         temp: template image or moving image
         shift: xdirection shift by pixel number
     Returns:
-        result: overlapping region of ref and temp
-    '''
-    result = np.copy(ref)
-    dim = np.shape(result)
-    for i in range(dim[0]):
-        for j in range(dim[1]):
-            xmin = (40-shift) + j
-            result[i][j] = temp[i][xmin]
+        result: overlapping region of ref and temp (a view into temp)
+    '''
+    xmin = 40 - shift
+    result = temp[:, xmin:xmin + ref.shape[1]]
     return result
 
 def prepare_image(image):
@@ -85,61 +90,119 @@ def prepare_image(image):
         green: cropped green channel
         red: red channel
     '''
-    green = extract_green(image)
+    green = extract_green(image)[:, 20:-20] #Drop first and last 20 columns
     red = extract_red(image)
-    for _ in range(20):
-        green = np.delete(green, 0, 1) #First Column
-        green = np.delete(green, -1, 1) #Last Column
     return green, red
 
-def marginal_pmf(image, bin_size, id0):
+def bin_index(image, bin_size):
     '''
-    Create Histogram for Probability of each Grey Value
+    Maps every pixel to the index of its grey value bin
     Args:
         image: numpy array of shape (imageheight, imagewidth)
         bin_size: how many neighbouring grey values to consider the same
 
     Returns:
-        green_image: numpy array of shape (imageheight, imagewidth)
+        bins: flat numpy uint8 array of bin indices, one per pixel
     '''
-    hist_vals = np.zeros(256)
-    count = 0
-    for row in image:
-        for i in range(len(row)):
-            pix = int(row[i])
-            hist_vals[pix] += 1
-            count += 1
-    i = 0
-    hist_result = []
-    for i in range(0, 255, bin_size):
-        var = 0
-        for j in range(bin_size):
-            var += hist_vals[i+j]
-        hist_result.append(var / count)
-        i = i * bin_size
-    return hist_result
+    n_bins = 256 // bin_size
+    # grey value 255 falls past the last full bin when 256 % bin_size != 0
+    bin_of = np.minimum(np.arange(256) // bin_size, n_bins - 1).astype(np.uint8)
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.intp)
+    #one table lookup per pixel instead of an integer division
+    bins = bin_of[image].ravel()
+    return bins
+
+if njit is not None:
+    @njit(parallel=True, nogil=True, cache=True)
+    def joint_hist(ref_bins, image2, n_bins, bin_size, n_chunks):
+        '''
+        Counts the 2D Histogram in one pass, quantizing image2 on the fly
+        Args:
+            ref_bins: bin indices of the reference, shape (imageheight, imagewidth)
+            image2: numpy array of shape (imageheight, imagewidth), template image
+            n_bins: number of bins per axis
+            bin_size: how many neighbouring grey values to consider the same
+            n_chunks: number of row blocks, at most one per thread and per row
 
-def joint_pmf(x_pmf, y_pmf):
+        Returns:
+            hist_result: numpy int64 array of shape (n_bins, n_bins)
+        '''
+        nrow, ncol = image2.shape
+        step = (nrow + n_chunks - 1) // n_chunks
+        #one private histogram per thread, summed at the end
+        local = np.zeros((n_chunks, n_bins, n_bins), np.int64)
+        for c in prange(n_chunks):
+            for i in range(c * step, min(nrow, (c + 1) * step)):
+                for j in range(ncol):
+                    v = min(max(image2[i, j], 0), 255)
+                    b = min(int(v) // bin_size, n_bins - 1)
+                    local[c, ref_bins[i, j], b] += 1
+        return local.sum(axis=0)
+
+def joint_counts(image1, image2, bin_size, ref_bins=None, temp_bins=None):
     '''
-    Produces the Normalized 2D Histogram 
+    Produces the 2D Histogram of the paired pixels as integer counts
     Args:
-        x_pmf: 1D Normalized Histogram of Reference Image
-        y_pmf: 1D Normalized Histogram of Template Image
+        image1: numpy array of shape (imageheight, imagewidth), reference image
+        image2: numpy array of shape (imageheight, imagewidth), template image
+        bin_size: how many neighbouring grey values to consider the same
+        ref_bins=None: precomputed bin_index(image1, bin_size), reused across shifts
+        temp_bins=None: precomputed bin indices of image2, shape (imageheight, imagewidth)
 
     Returns:
-        hist_result: The 2D Normalized Histogram
-    '''
-    nrow = len(x_pmf)
-    ncol = len(y_pmf)
-    hist_result = np.zeros((nrow, ncol))
-    track = 0
-    for i in range(nrow):
-        for j in range(ncol):
-            hist_result[i, j] = x_pmf[i] + y_pmf[j]
-    hist_result = hist_result / np.sum(hist_result)
+        hist_result: numpy int64 array of shape (n_bins, n_bins)
+    '''
+    n_bins = 256 // bin_size
+    a = bin_index(image1, bin_size) if ref_bins is None else ref_bins
+    #bin indices are already quantized, so they are binned again with a step of 1
+    image2, step = (image2, bin_size) if temp_bins is None else (temp_bins, 1)
+    if njit is not None and image2.size >= NUMBA_MIN_PIXELS:
+        #thread count is read here, a global lookup inside the kernel would stop it caching
+        n_chunks = min(get_num_threads(), image2.shape[0])
+        hist_result = joint_hist(a.reshape(image2.shape), image2, n_bins, step, n_chunks)
+    elif histogram2d is not None:
+        #histogram the bin indices, so the edges match bin_size even when 256 % bin_size != 0
+        b = bin_index(image2, step)
+        hist_result = histogram2d(a, b, range=[[0, n_bins], [0, n_bins]], bins=n_bins)
+        hist_result = hist_result.astype(np.int64)
+    else:
+        b = bin_index(image2, step)
+        hist_result = np.bincount(a.astype(np.intp) * n_bins + b, minlength=n_bins * n_bins)
+        hist_result = hist_result.reshape(n_bins, n_bins)
     return hist_result
 
-def mutual_information(image1, image2, id0, bin_size=1):
+def log2_table(N):
+    '''
+    Lookup table of log2 for every possible histogram count
+    Args:
+        N: largest count, i.e. the number of paired pixels
+
+    Returns:
+        table: numpy array of shape (N+1,) with table[k] = log2(k) and table[0] = 0
+    '''
+    table = np.empty(N + 1)
+    table[0] = 0
+    table[1:] = np.log2(np.arange(1, N + 1))
+    return table
+
+def sum_clogc(counts, table=None):
+    '''
+    Sums c * log2(c) over the non-empty cells of a histogram
+    Args:
+        counts: numpy array of integer histogram counts
+        table=None: log2_table covering the largest count, looked up instead of calling log2
+
+    Returns:
+        result: float, empty cells contribute 0
+    '''
+    if table is not None:
+        c = counts.ravel()
+        return np.dot(table[c], c)
+    c = counts[counts > 0]
+    return np.dot(c, np.log2(c))
+
+def mutual_information(image1, image2, id0, bin_size=1, ref_bins=None, temp_bins=None, table=None):
     '''
     Calculates the Mutual Information between the inputs
     Args:
@@ -147,39 +210,90 @@ def mutual_information(image1, image2, id0, bin_size=1):
         image2: template image
         id0: identifier for histogram plots
         bin_size=1: Number of neighbouring grey values to consider the same
+        ref_bins=None: precomputed bin_index(image1, bin_size) of the reference
+        temp_bins=None: precomputed bin indices of image2, shaped like image2
+        table=None: log2_table(image1.size), shared by calls on the same image size
 
     Returns:
         result: A value for the mutual information according to EQ1
     '''
-    px = marginal_pmf(image1, bin_size, id0)
-    py = marginal_pmf(image2, bin_size, id0+100)
-    pxy = joint_pmf(px, py)
-    mutual_information = 0
-    visual = np.copy(pxy)
-    for i in range(len(px)):
-        for j in range(len(py)):
-            var1 = px[i] * py[j]
-            var2 = pxy[i, j] / var1
-            partial = pxy[i, j] * math.log(var2, 2)
-            visual[i,j] = partial
-            mutual_information += partial
-    #plt.imshow(visual, cmap='gray')
-    #fn = 'mi_' + str(id0) + '.png'
-    #plt.savefig(fn)
-    #plt.clf()
+    cxy = joint_counts(image1, image2, bin_size, ref_bins, temp_bins)
+    cx = cxy.sum(1)
+    cy = cxy.sum(0)
+    N = cxy.sum()
+    #EQ1 with p = c / N: log2(N) + (sum c log c - sum cx log cx - sum cy log cy) / N
+    logN = np.log2(N) if table is None else table[N]
+    mutual_information = logN + (sum_clogc(cxy, table) - sum_clogc(cx, table) - sum_clogc(cy, table)) / N
     return mutual_information
 
-def registration(image):
-    reference, template = prepare_image(image)
-    save(reference, '../output/ref.png')
-    save(template, '../output/temp.png')
-    results = []
-    for i in range(41):
-        overlappingregion = overlap(reference, template, i)
-        MI = mutual_information(reference, overlappingregion, i, bin_size=3)
-        results.append(MI)
+def shift_scores(ref_bins, temp_bins, shifts, bin_size, step=1):
+    '''
+    Mutual information of the binned reference against the binned template at each shift
+    Args:
+        ref_bins: bin indices of the reference, shape (imageheight, imagewidth)
+        temp_bins: bin indices of the template, shape (imageheight, imagewidth + 40)
+        shifts: xdirection shifts to score
+        bin_size: Number of neighbouring grey values to consider the same
+        step=1: only pair every step-th row and column of the reference frame
+    Returns:
+        results: numpy array with the mutual information of every shift
+    '''
+    #Subsampling the reference frame keeps every shift available, unlike downsampling the template
+    ref = np.ascontiguousarray(ref_bins[::step, ::step])
+    flat_ref = ref.ravel()
+    table = log2_table(ref.size) #Every shift pairs the same number of pixels
+
+    def mi_for_shift(i):
+        window = overlap(ref_bins, temp_bins, i)[::step, ::step]
+        return mutual_information(ref, window, i, bin_size,
+                                  ref_bins=flat_ref, temp_bins=window, table=table)
+
+    #Shifts are independent. The numba kernel already spreads each shift over every core,
+    #otherwise run the shifts side by side in threads since the histogram code drops the GIL
+    shifts = list(shifts)
+    results = np.empty(len(shifts))
+    if njit is None or ref.size < NUMBA_MIN_PIXELS:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for k, MI in enumerate(pool.map(mi_for_shift, shifts)):
+                results[k] = MI
+    else:
+        for k, i in enumerate(shifts):
+            results[k] = mi_for_shift(i)
     return results
 
+def registration(image, save_debug=False):
+    reference, template = prepare_image(image)
+    if save_debug:
+        save(reference, '../output/ref.png')
+        save(template, '../output/temp.png')
+    #Both images are the same for every shift, so quantize them once and slide over the bins
+    ref_bins = bin_index(reference, 3).reshape(reference.shape)
+    temp_bins = bin_index(template, 3).reshape(template.shape)
+    return shift_scores(ref_bins, temp_bins, range(41), 3)
+
+def coarse_to_fine_registration(image, bin_size=3, step=4, top_k=5):
+    '''
+    Finds the best shift like registration, but scores all 41 shifts on every step-th
+    row and column first and only recomputes the top_k candidates at full resolution
+    Args:
+        image: input grayscale RGB image
+        bin_size=3: Number of neighbouring grey values to consider the same
+        step=4: subsampling of the paired pixels in the coarse pass
+        top_k=5: number of coarse candidates rescored at full resolution
+    Returns:
+        shift: xdirection shift with the highest mutual information
+        MI: its full resolution mutual information
+    '''
+    reference, template = prepare_image(image)
+    ref_bins = bin_index(reference, bin_size).reshape(reference.shape)
+    temp_bins = bin_index(template, bin_size).reshape(template.shape)
+    coarse = shift_scores(ref_bins, temp_bins, range(41), bin_size, step)
+    #Aligned images share the most information, so keep the highest coarse scores
+    candidates = np.argsort(coarse)[::-1][:top_k]
+    fine = shift_scores(ref_bins, temp_bins, candidates, bin_size)
+    best = np.argmax(fine)
+    return int(candidates[best]), float(fine[best])
+
 test = load('../input/test3.jpeg')
 
 
@@ -190,20 +304,25 @@ var = 0.1
 sigma = var**0.5
 gauss = np.random.normal(mean,sigma,(row,col,ch))
 gauss = gauss.reshape(row,col,ch)
-noisy = test + gauss - 1
+noisy = np.clip(test + gauss - 1, 0, 255).astype(np.uint8)
 save(noisy, '../output/gauss_noise3.png')
  
 # comment out the above block to obtain experimental results
 
-values = registration(noisy)
+values = registration(noisy, save_debug=True)
 print(values)
-print(np.min(values), np.argmin(values))
+shift, MI = coarse_to_fine_registration(noisy) #Best alignment has the highest MI
+print(MI, shift)
 plt.plot(values)
 plt.xlabel("Shift in X Direction")
 plt.ylabel("Mutual Information")
 plt.savefig("../output/mi_plot1_bin3.png")
 plt.clf()
 '''
+Results from the previous metric (joint_pmf built as the normalized sum of the marginals,
+best shift taken as the minimum). Kept for reference only, they are not mutual information
+values and do not match the output of the script above.
+
 Image 1 Results: 
     values: [0.9208992008321772, 0.9216674192767316, 0.9226925473169687, 0.9236530943068013, 0.9245944102082683, 0.9253195208875502, 0.9259800799097523, 0.9267518801815103, 0.9273534419521324, 0.92815607960689, 0.929206510635319, 0.9302752817745638, 0.9314631751394911, 0.9322023325769789, 0.9331031779934744, 0.9340157989399234, 0.9349048829427431, 0.9356536957137305, 0.9364845976835522, 0.9373659309028057, 0.9381289870348896, 0.9390152455502615, 0.940014734791387, 0.9406852031892886, 0.9412706927191858, 0.94183001623625, 0.94233069313878, 0.9427083721643773, 0.9430443102729951, 0.9433854839916053, 0.9437440616191268, 0.9442443506439835, 0.9444993361218221, 0.9447610928783307, 0.944948547884882, 0.9451151774989712, 0.9453340376252298, 0.9455893577008757, 0.9458764827769989, 0.9459383529162547, 0.9459331251996006]
     min(MI): 0.9208992008321772, Shift: 0